@@ -3,17 +3,80 @@
 LLMD xKS preflight checks.
 """
 
+import collections
+import collections.abc
 import configargparse  # pyright: ignore[reportMissingImports]
+import concurrent.futures
+import dataclasses
+import functools
+import inspect
 import sys
 import logging
 import os
+import threading
 import kubernetes  # pyright: ignore[reportMissingImports]
 
+try:
+    # orjson decodes large node lists several times faster than the stdlib parser
+    from orjson import loads as json_loads  # pyright: ignore[reportMissingImports]
+except ImportError:
+    from json import loads as json_loads
+
+# ask the apiserver for metadata only (no spec or status)
+NODE_METADATA_ACCEPT = "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=1,application/json"
+# kubernetes >= 36 generated APIs accept per-request headers, older clients always send their own Accept
+# and get full nodes back as JSON, which carry the same metadata
+LIST_NODE_HEADERS = "_headers" in inspect.signature(kubernetes.client.CoreV1Api.list_node).parameters
+# nodes fetched per LIST page, bounds how many raw nodes are held in memory at once
+NODE_PAGE_SIZE = 500
+
+NVIDIA_GPU_PRESENT_LABEL = "nvidia.com/gpu.present"
+NVIDIA_GPU_RESOURCE = "nvidia.com/gpu"
+INSTANCE_TYPE_LABEL = "beta.kubernetes.io/instance-type"
+
+# node labels identifying each cloud provider
+CLOUD_PROVIDER_LABELS = {
+    "azure": "kubernetes.azure.com/cluster",
+}
+
+# Azure instance types with supported accelerators
+AZURE_INSTANCE_TYPES = frozenset({
+    "Standard_NC24ads_A100_v4",
+    "Standard_ND96asr_v4",
+    "Standard_ND96amsr_A100_v4",
+    "Standard_ND96isr_H100_v5",
+    "Standard_ND96isr_H200_v5",
+    "Standard_NC4as_T4_v3",
+})
+AZURE_INSTANCE_TYPE_SELECTOR = f"{INSTANCE_TYPE_LABEL} in ({','.join(sorted(AZURE_INSTANCE_TYPES))})"
+
+
+@dataclasses.dataclass(slots=True)
+class PreflightTest:
+    name: str
+    function: collections.abc.Callable[[], bool]
+    description: str
+    suggested_action: str
+    result: bool = False
+    optional: bool = False
+
+
+@functools.lru_cache(maxsize=1)
+def _k8s_clients():
+    # loading kubeconfig parses YAML and may run exec auth plugins, only do it once per process
+    configuration = kubernetes.client.Configuration()
+    kubernetes.config.load_kube_config(client_configuration=configuration)
+    # share one connection pool between the APIs and let the apiserver compress large lists
+    api_client = kubernetes.client.ApiClient(configuration)
+    api_client.set_default_header("Accept-Encoding", "gzip")
+    return kubernetes.client.CoreV1Api(api_client), kubernetes.client.ApiextensionsV1Api(api_client)
+
 
 class LLMDXKSChecks:
     def __init__(self, **kwargs):
         self.log_level = kwargs.get("log_level", "INFO")
         self.logger = self._log_init()
+        self._debug = self.logger.isEnabledFor(logging.DEBUG)
 
         self.cloud_provider = kwargs.get("cloud_provider", "auto")
 
@@ -27,6 +90,8 @@ class LLMDXKSChecks:
             self.logger.error("Failed to connect to Kubernetes cluster")
             sys.exit(1)
 
+        self.node_labels_cache = None
+
         if self.cloud_provider == "auto":
             self.cloud_provider = self.detect_cloud_provider()
             if self.cloud_provider == "none":
@@ -37,44 +102,40 @@ class LLMDXKSChecks:
             self.logger.info(f"Cloud provider specified: {self.cloud_provider}")
 
         self.crds_cache = None
+        self.crds_lock = threading.Lock()
 
         self.tests = [
-            {
-                "name": "instance_type",
-                "function": self.test_instance_type,
-                "description": "Test if the cluster has at least one supported instance type",
-                "suggested_action": "Provision a cluster with at least one supported instance type",
-                "result": False
-            },
-            {
-                "name": "gpu_availablity",
-                "function": self.test_gpu_availablity,
-                "description": "Test if the cluster has GPU drivers",
-                "suggested_action": "Provision a cluster with at least one supported GPU driver",
-                "result": False
-            },
-            {
-                "name": "crd_certmanager",
-                "function": self.test_crd_certmanager,
-                "description": "test if the cluster has the cert-manager crds",
-                "suggested_action": "install cert-manager",
-                "result": False
-            },
-            {
-                "name": "crd_sailoperator",
-                "function": self.test_crd_sailoperator,
-                "description": "test if the cluster has the sailoperator crds",
-                "suggested_action": "install sail-operator",
-                "result": False
-            },
-            {
-                "name": "crd_lwsoperator",
-                "function": self.test_crd_lwsoperator,
-                "description": "test if the cluster has the lws-operator crds",
-                "suggested_action": "install lws-operator",
-                "result": False,
-                "optional": True
-            },
+            PreflightTest(
+                name="instance_type",
+                function=self.test_instance_type,
+                description="Test if the cluster has at least one supported instance type",
+                suggested_action="Provision a cluster with at least one supported instance type",
+            ),
+            PreflightTest(
+                name="gpu_availablity",
+                function=self.test_gpu_availablity,
+                description="Test if the cluster has GPU drivers",
+                suggested_action="Provision a cluster with at least one supported GPU driver",
+            ),
+            PreflightTest(
+                name="crd_certmanager",
+                function=self.test_crd_certmanager,
+                description="test if the cluster has the cert-manager crds",
+                suggested_action="install cert-manager",
+            ),
+            PreflightTest(
+                name="crd_sailoperator",
+                function=self.test_crd_sailoperator,
+                description="test if the cluster has the sailoperator crds",
+                suggested_action="install sail-operator",
+            ),
+            PreflightTest(
+                name="crd_lwsoperator",
+                function=self.test_crd_lwsoperator,
+                description="test if the cluster has the lws-operator crds",
+                suggested_action="install lws-operator",
+                optional=True,
+            ),
         ]
 
         self.run(self.tests)
@@ -90,29 +151,59 @@ class LLMDXKSChecks:
 
     def _k8s_connection(self):
         try:
-            kubernetes.config.load_kube_config()
-            core_api = kubernetes.client.CoreV1Api()
-            ext_api = kubernetes.client.ApiextensionsV1Api()
+            core_api, ext_api = _k8s_clients()
         except Exception as e:
             self.logger.error(f"{e}")
             return None
         self.logger.info("Kubernetes connection established")
         return core_api, ext_api
 
-    def _get_all_crd_names(self, cache=True):
-        if cache and self.crds_cache is not None:
-            return self.crds_cache
-        crd_list = self.k8s_ext_api.list_custom_resource_definition()
+    def _iter_nodes(self, accept=NODE_METADATA_ACCEPT, label_selector=None, limit=NODE_PAGE_SIZE):
+        # nodes are yielded page by page as decoded JSON, building V1Node models costs more than the transfer
+        list_kwargs = {
+            "label_selector": label_selector,
+            "limit": limit,
+            "_preload_content": False,
+        }
+        while True:
+            if LIST_NODE_HEADERS:
+                # the generated serializer adds auth and default headers to the dict it is given, pass a fresh one
+                list_kwargs["_headers"] = {"Accept": accept}
+            response = self.k8s_core_api.list_node(**list_kwargs)
+            node_list = json_loads(response.data)
+            yield from node_list.get("items") or []
+            continue_token = (node_list.get("metadata") or {}).get("continue")
+            if not continue_token:
+                return
+            list_kwargs["_continue"] = continue_token
+
+    def _get_node_labels(self, cache=True):
+        if cache and self.node_labels_cache is not None:
+            return self.node_labels_cache
+        node_labels = {}
+        for node in self._iter_nodes():
+            metadata = node["metadata"]
+            node_labels[metadata["name"]] = metadata.get("labels") or {}
         if cache:
-            self.crds_cache = {crd.metadata.name for crd in crd_list.items}
-        return {crd.metadata.name for crd in crd_list.items}
+            self.node_labels_cache = node_labels
+        return node_labels
+
+    def _get_all_crd_names(self, cache=True):
+        # CRD tests run concurrently, only let the first one list CRDs
+        with self.crds_lock:
+            if cache and self.crds_cache is not None:
+                return self.crds_cache
+            crd_list = self.k8s_ext_api.list_custom_resource_definition()
+            if cache:
+                self.crds_cache = {crd.metadata.name for crd in crd_list.items}
+            return {crd.metadata.name for crd in crd_list.items}
 
     def _test_crds_present(self, required_crds):
         all_crds = self._get_all_crd_names()
         return_value = True
         for crd in required_crds:
             if crd not in all_crds:
-                self.logger.warning(f"Missing CRD: {crd}")
+                self.logger.warning("Missing CRD: %s", crd)
                 return_value = False
         self.logger.debug("All tested CRDs are present")
         return return_value
@@ -158,67 +249,67 @@ class LLMDXKSChecks:
             return False
 
     def test_gpu_availablity(self):
-        def nvidia_driver_present(node):
-            if "nvidia.com/gpu" in node.status.allocatable.keys():
-                if int(node.status.allocatable["nvidia.com/gpu"]) > 0:
+        def gpus_allocatable(quantity):
+            # the apiserver returns canonical quantities, so plain counts need no parsing
+            if quantity.isdigit():
+                return quantity != "0"
+            return kubernetes.utils.parse_quantity(quantity) > 0
+
+        def nvidia_driver_present(name, status):
+            allocatable = status.get("allocatable") or {}
+            if NVIDIA_GPU_RESOURCE in allocatable:
+                if gpus_allocatable(allocatable[NVIDIA_GPU_RESOURCE]):
                     return True
                 else:
-                    self.logger.warning(f"No allocatabled NVIDIA GPUs on node {node.metadata.name}\
-                         - no NVIDIA GPU drivers present")
+                    self.logger.warning(
+                        "No allocatabled NVIDIA GPUs on node %s - no NVIDIA GPU drivers present", name)
                     return False
             else:
-                self.logger.warning(f"No NVIDIA GPU drivers present on node {node.metadata.name}\
-                     - no NVIDIA GPU accelerators present")
+                self.logger.warning(
+                    "No NVIDIA GPU drivers present on node %s - no NVIDIA GPU accelerators present", name)
                 return False
 
-        accelerators = {
-            "nvidia": 0,
-            "other": 0,
-        }
-        nodes = self.k8s_core_api.list_node()
-        for node in nodes.items:
-            labels = node.metadata.labels
-            if "nvidia.com/gpu.present" in labels:
-                accelerators["nvidia"] += 1
-                self.logger.info(f"NVIDIA GPU accelerator present on node {node.metadata.name}")
-                if not nvidia_driver_present(node):
-                    return False
-            else:
-                accelerators["other"] += 1
-        if accelerators["other"] == len(nodes.items):
+        # GPU nodes need status, so list full objects, but only those labeled by the NVIDIA GPU operator
+        gpu_nodes = self._iter_nodes(
+            accept="application/json",
+            label_selector=NVIDIA_GPU_PRESENT_LABEL,
+        )
+        gpu_nodes_found = False
+        debug = self.logger.debug
+        for node in gpu_nodes:
+            gpu_nodes_found = True
+            name = node["metadata"]["name"]
+            debug("NVIDIA GPU accelerator present on node %s", name)
+            if not nvidia_driver_present(name, node.get("status") or {}):
+                return False
+        if not gpu_nodes_found:
             self.logger.warning("No supported GPU drivers found")
             return False
-        else:
-            self.logger.info("At least one supported GPU driver found")
-            return True
+        self.logger.info("At least one supported GPU driver found")
+        return True
 
     def test_instance_type(self):
         def azure_instance_type(self):
-            instance_types = {
-                "Standard_NC24ads_A100_v4": 0,
-                "Standard_ND96asr_v4": 0,
-                "Standard_ND96amsr_A100_v4": 0,
-                "Standard_ND96isr_H100_v5": 0,
-                "Standard_ND96isr_H200_v5": 0,
-                "Standard_NC4as_T4_v3": 0,
-            }
-            nodes = self.k8s_core_api.list_node()
-            for node in nodes.items:
-                labels = node.metadata.labels
-                if "beta.kubernetes.io/instance-type" in labels:
-                    try:
-                        instance_types[labels["beta.kubernetes.io/instance-type"]] += 1
-                    except KeyError:
-                        # ignore unknown instance types
-                        pass
-            max_instance_type = max(instance_types, key=instance_types.get)
-            if instance_types[max_instance_type] == 0:
+            if self._debug:
+                instance_types = collections.Counter(
+                    labels.get(INSTANCE_TYPE_LABEL) for labels in self._get_node_labels().values()
+                )
+                self.logger.debug(f"Instances by type: {dict(instance_types)}")
+            if self.node_labels_cache is not None:
+                # reuse the label snapshot, isdisjoint() stops at the first supported type
+                node_instance_types = (
+                    labels.get(INSTANCE_TYPE_LABEL) for labels in self.node_labels_cache.values()
+                )
+                supported = not AZURE_INSTANCE_TYPES.isdisjoint(node_instance_types)
+            else:
+                # no snapshot yet, let the apiserver find a single matching node
+                matching_nodes = self._iter_nodes(label_selector=AZURE_INSTANCE_TYPE_SELECTOR, limit=1)
+                supported = next(matching_nodes, None) is not None
+            if not supported:
                 self.logger.warning("No supported instance type found")
                 return False
-            else:
-                self.logger.info("At least one supported Azure instance type found")
-                self.logger.debug(f"Instances by type: {instance_types}")
-                return True
+            self.logger.info("At least one supported Azure instance type found")
+            return True
 
         if self.cloud_provider == "azure":
             return azure_instance_type(self)
@@ -227,39 +318,39 @@ class LLMDXKSChecks:
             return False
 
     def detect_cloud_provider(self):
-        clouds = {
-            "none": 0,
-            "azure": 0,
-            "aws": 0
-        }
-        nodes = self.k8s_core_api.list_node()
-        for node in nodes.items:
-            labels = node.metadata.labels
-            if "kubernetes.azure.com/cluster" in labels:
-                clouds["azure"] += 1
-
-        return max(clouds, key=clouds.get)
-
-    def run(self, tests=[]):
-        for test in tests:
-            if test["function"]():
-                self.logger.debug(f"Test {test['name']} passed")
-                test["result"] = True
-            else:
-                self.logger.error(f"Test {test['name']} failed")
-                test["result"] = False
+        # share the node label snapshot with the tests instead of probing the apiserver per provider
+        node_labels = self._get_node_labels()
+        for cloud, label in CLOUD_PROVIDER_LABELS.items():
+            if any(label in labels for labels in node_labels.values()):
+                self.logger.debug(f"Found node with label {label}")
+                return cloud
+        return "none"
+
+    def run(self, tests=None):
+        if not tests:
+            return None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(tests)) as executor:
+            futures = {executor.submit(test.function): test for test in tests}
+            for future in concurrent.futures.as_completed(futures):
+                test = futures[future]
+                if future.result():
+                    self.logger.debug(f"Test {test.name} passed")
+                    test.result = True
+                else:
+                    self.logger.error(f"Test {test.name} failed")
+                    test.result = False
         return None
 
     def report(self):
         for test in self.tests:
-            if test["result"]:
-                print(f"Test {test['name']} PASSED")
+            if test.result:
+                print(f"Test {test.name} PASSED")
             else:
-                if "optional" in test.keys() and test["optional"]:
-                    print(f"Test {test['name']} OPTIONAL [failed]")
+                if test.optional:
+                    print(f"Test {test.name} OPTIONAL [failed]")
                 else:
-                    print(f"Test {test['name']} FAILED")
-                    print(f"    Suggested action: {test['suggested_action']}")
+                    print(f"Test {test.name} FAILED")
+                    print(f"    Suggested action: {test.suggested_action}")
         return None
 
 